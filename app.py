@@ -1,20 +1,30 @@
 import os
 import json
+import orjson
 import streamlit as st
-from openai import OpenAI
-from supabase import create_client, Client
-from io import StringIO, BytesIO
-from tempfile import NamedTemporaryFile
+from openai import OpenAI, APIConnectionError, APIStatusError
+from supabase import create_client, ClientOptions
+import httpx
+from postgrest.types import ReturnMethod
+from io import BytesIO
 import time
-import PyPDF2
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 import docx2txt
 from dotenv import load_dotenv
 import base64
 from PIL import Image
 import uuid
+import hashlib
+import threading
 import fitz
+import pymupdf4llm
+import tiktoken
 import zipfile
+import re
 from xml.etree import ElementTree
+from urllib.parse import quote
+from tenacity import retry, retry_if_exception, wait_random_exponential, stop_after_attempt
 
 # Client / credential set-up
 load_dotenv()
@@ -28,179 +38,277 @@ def get_env_variable(var_name):
 openai_api_key = get_env_variable("OPENAI_API_KEY")
 supabase_url = get_env_variable("SUPABASE_URL")
 supabase_key = get_env_variable("SUPABASE_KEY")
+# Parsing model - schema-constrained extraction works well on the small tier; set
+# OPENAI_MODEL (e.g. gpt-4.1) to trade cost and latency for accuracy on hard documents
+openai_model = get_env_variable("OPENAI_MODEL") or "gpt-4o-mini"
+# Larger-output model (32k output tokens vs gpt-4o-mini's 16k) that a request is re-sent to
+# when its completion is cut off at the token limit - ideal answers are copied verbatim,
+# so output grows with the document
+openai_fallback_model = get_env_variable("OPENAI_FALLBACK_MODEL") or "gpt-4.1"
 
 if not openai_api_key or not supabase_url or not supabase_key:
     st.error("API keys or credentials are not properly set.")
     st.stop()
 
-client = OpenAI(api_key=openai_api_key)
-supabase: Client = create_client(supabase_url, supabase_key)
+@st.cache_resource(show_spinner=False)
+def get_clients(openai_api_key, supabase_url, supabase_key):
+    """OpenAI and Supabase clients, built once per process rather than on every rerun"""
+    # Retries are handled by tenacity around each completion (see run_structured_completion)
+    openai_client = OpenAI(api_key=openai_api_key, max_retries=0)
+    
+    # One pooled HTTP/2 client for every Supabase request, so lookups, inserts and storage
+    # uploads reuse warm connections instead of renegotiating TLS. Keep the pool below the
+    # database pooler's client limit. Sharing one client needs supabase>=2.32: older
+    # sub-clients overwrite its base_url, which sends storage calls to PostgREST.
+    supabase_http = httpx.Client(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=20),
+        timeout=30
+    )
+    supabase_client = create_client(supabase_url, supabase_key, options=ClientOptions(httpx_client=supabase_http))
+    
+    return openai_client, supabase_client
+
+client, supabase = get_clients(openai_api_key, supabase_url, supabase_key)
 
 # Helper Functions for Image Processing
+IMAGE_CONTENT_TYPES = {
+    'jpg': 'image/jpeg',
+    'jpeg': 'image/jpeg',
+    'png': 'image/png',
+    'gif': 'image/gif',
+    'bmp': 'image/bmp',
+    'webp': 'image/webp',
+    'tif': 'image/tiff',
+    'tiff': 'image/tiff'
+}
+
+# Media types pulled out of word/media/ (webp is used by Office 2021+)
+DOCX_IMAGE_EXTENSIONS = frozenset({'.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp', '.tif', '.tiff'})
+
+@st.cache_resource(show_spinner=False)
 def create_supabase_bucket_if_not_exists():
-    """Ensure the mcq-images bucket exists in Supabase Storage"""
+    """Ensure the mcq-images bucket exists in Supabase Storage (once per process; raises on failure so it is retried)"""
     try:
         supabase.storage.get_bucket('mcq-images')
     except:
+        supabase.storage.create_bucket('mcq-images', {'public': True})
+        st.info("Created mcq-images storage bucket")
+    return True
+
+@st.cache_resource(show_spinner=False)
+def get_uploaded_image_urls():
+    """Process-wide map of image SHA-256 to public URL, shared by upload workers"""
+    return {}, threading.Lock()
+
+def upload_image_to_supabase_storage(image_data, original_filename, log, scenario_index=0, max_attempts=3):
+    """Upload raw image bytes to Supabase Storage and return public URL, retrying with exponential backoff"""
+    # Generate unique filename with scenario context
+    file_extension = original_filename.split('.')[-1].lower() if '.' in original_filename else 'png'
+    unique_filename = f"saq_scenario_{scenario_index}_{uuid.uuid4()}.{file_extension}"
+    
+    # Identical bytes were already uploaded - reuse that URL instead of uploading again
+    digest = hashlib.sha256(image_data).hexdigest()
+    uploaded_urls, uploaded_urls_lock = get_uploaded_image_urls()
+    with uploaded_urls_lock:
+        if digest in uploaded_urls:
+            log.append(("info", f"Reusing previously uploaded image for {original_filename}"))
+            return uploaded_urls[digest]
+    
+    # A signed upload URL would cost an extra round-trip per image (one call to sign,
+    # one to PUT) against the same Storage API, so upload directly through one bucket
+    # handle; get_public_url only formats a URL and makes no request
+    bucket = supabase.storage.from_("mcq-images")
+    content_type = IMAGE_CONTENT_TYPES.get(file_extension, f"image/{file_extension}")
+    
+    for attempt in range(max_attempts):
         try:
-            supabase.storage.create_bucket('mcq-images', {'public': True})
-            st.info("Created mcq-images storage bucket")
+            # Upload to Supabase Storage
+            response = bucket.upload(
+                path=unique_filename,
+                file=image_data,
+                file_options={"content-type": content_type}
+            )
+            
+            # Get public URL
+            public_url_response = bucket.get_public_url(unique_filename)
+            public_url = public_url_response.get('publicUrl') if hasattr(public_url_response, 'get') else str(public_url_response)
+            
+            with uploaded_urls_lock:
+                uploaded_urls[digest] = public_url
+            
+            log.append(("success", f"Uploaded SAQ image: {unique_filename}"))
+            return public_url
+            
         except Exception as e:
-            st.warning(f"Could not create storage bucket: {e}")
+            if attempt < max_attempts - 1:
+                time.sleep(2 ** attempt)
+            else:
+                log.append(("error", f"Error uploading image to Supabase Storage after {max_attempts} attempts: {e}"))
+    
+    return None
 
-def upload_image_to_supabase_storage(image_data, original_filename, scenario_index=0):
-    """Upload image to Supabase Storage and return public URL"""
-    try:
-        create_supabase_bucket_if_not_exists()
-        
-        # Generate unique filename with scenario context
-        file_extension = original_filename.split('.')[-1] if '.' in original_filename else 'png'
-        unique_filename = f"saq_scenario_{scenario_index}_{uuid.uuid4()}.{file_extension}"
-        
-        # Convert to bytes if it's a PIL Image
-        if isinstance(image_data, Image.Image):
-            img_byte_arr = BytesIO()
-            image_data.save(img_byte_arr, format='PNG')
-            image_data = img_byte_arr.getvalue()
-        
-        # Upload to Supabase Storage
-        response = supabase.storage.from_("mcq-images").upload(
-            path=unique_filename,
-            file=image_data,
-            file_options={"content-type": f"image/{file_extension}"}
-        )
-        
-        # Get public URL
-        public_url_response = supabase.storage.from_("mcq-images").get_public_url(unique_filename)
-        public_url = public_url_response.get('publicUrl') if hasattr(public_url_response, 'get') else str(public_url_response)
-        
-        st.success(f"Uploaded SAQ image: {unique_filename}")
-        return public_url
-        
-    except Exception as e:
-        st.error(f"Error uploading image to Supabase Storage: {e}")
-        return None
+def probe_image_size(image_bytes):
+    """Read image dimensions from the header without decoding pixel data"""
+    with Image.open(BytesIO(image_bytes)) as probe:
+        return probe.size
 
-def extract_images_from_pdf_advanced(pdf_path):
-    """Extract images from PDF with position information using PyMuPDF"""
+# Separator between PDF pages in extracted text (a form feed, which reads as whitespace to the model)
+PAGE_BREAK = "\f"
+
+def extract_text_and_images_from_pdf(pdf_bytes, log):
+    """Extract text and images (with position information) from PDF in a single PyMuPDF pass"""
     images = []
-    try:
-        doc = fitz.open(pdf_path)
+    extracted_xrefs = {}
+    seen_digests = {}
+    
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+        # Markdown keeps headings, lists and tables, so the model does not have to rebuild
+        # the structure from flat text. Pages are joined with PAGE_BREAK so long documents
+        # can later be split on page boundaries, where the images on each page are known
+        text_content = PAGE_BREAK.join(page_chunk["text"] for page_chunk in pymupdf4llm.to_markdown(doc, page_chunks=True))
         
         for page_num in range(len(doc)):
             page = doc.load_page(page_num)
             
-            # Get text blocks to understand content structure
-            text_blocks = page.get_text("dict")
-            
             # Get images on this page
             image_list = page.get_images(full=True)
             
             for img_index, img in enumerate(image_list):
                 try:
                     xref = img[0]
-                    base_image = doc.extract_image(xref)
-                    image_bytes = base_image["image"]
-                    image_ext = base_image["ext"]
                     
-                    # Get image rectangle (position on page)
-                    img_rect = page.get_image_rects(img)[0] if page.get_image_rects(img) else None
+                    # The same image object can be placed on several pages - only decode it once
+                    if xref not in extracted_xrefs:
+                        base_image = doc.extract_image(xref)
+                        image_bytes = base_image["image"]
+                        
+                        # Different objects can still carry identical bytes (e.g. a re-embedded logo)
+                        digest = hashlib.sha256(image_bytes).hexdigest()
+                        image_bytes = seen_digests.setdefault(digest, image_bytes)
+                        extracted_xrefs[xref] = (image_bytes, base_image["ext"], digest, probe_image_size(image_bytes))
+                    
+                    image_bytes, image_ext, digest, image_size = extracted_xrefs[xref]
                     
-                    # Convert to PIL Image for processing
-                    pil_image = Image.open(BytesIO(image_bytes))
+                    # Get image rectangle (position on page)
+                    rects = page.get_image_rects(img)
+                    # Stored as a plain tuple so cached extraction results pickle cleanly
+                    img_rect = tuple(rects[0]) if rects else None
                     
                     image_info = {
                         'data': image_bytes,
-                        'pil_image': pil_image,
+                        'sha256': digest,
                         'page': page_num + 1,
                         'index': img_index,
                         'filename': f'page_{page_num + 1}_img_{img_index}.{image_ext}',
                         'extension': image_ext,
                         'rect': img_rect,
-                        'size': pil_image.size if pil_image else None
+                        'size': image_size
                     }
                     
                     images.append(image_info)
                     
                 except Exception as img_error:
-                    st.warning(f"Could not extract image {img_index} from page {page_num + 1}: {img_error}")
+                    log.append(("warning", f"Could not extract image {img_index} from page {page_num + 1}: {img_error}"))
                     continue
-        
-        doc.close()
-        return images
-        
-    except Exception as e:
-        st.error(f"Error extracting images from PDF: {e}")
-        return []
+    
+    return text_content, images
 
-def extract_images_from_docx_advanced(docx_path):
+def extract_images_from_docx_advanced(docx_bytes, log):
     """Extract images from DOCX file with better handling"""
     images = []
     try:
-        with zipfile.ZipFile(docx_path, 'r') as docx_zip:
+        with zipfile.ZipFile(BytesIO(docx_bytes), 'r') as docx_zip:
             # Get all image files from the media folder
-            image_files = [f for f in docx_zip.namelist() if f.startswith('word/media/') and any(f.endswith(ext) for ext in ['.png', '.jpg', '.jpeg', '.gif', '.bmp'])]
+            image_files = [f for f in docx_zip.namelist() if f.startswith('word/media/') and os.path.splitext(f)[1].lower() in DOCX_IMAGE_EXTENSIONS]
             
             for i, img_file in enumerate(image_files):
                 try:
-                    img_data = docx_zip.read(img_file)
-                    filename = img_file.split('/')[-1]
+                    # Probe the header straight from the archive member, so an entry Pillow
+                    # cannot identify is rejected before it is fully decompressed into memory
+                    with docx_zip.open(img_file) as fp:
+                        with Image.open(fp) as probe:
+                            image_size = probe.size
                     
-                    # Convert to PIL Image
-                    pil_image = Image.open(BytesIO(img_data))
+                    with docx_zip.open(img_file) as fp:
+                        img_data = fp.read()
+                    filename = img_file.split('/')[-1]
                     
                     image_info = {
                         'data': img_data,
-                        'pil_image': pil_image,
+                        'sha256': hashlib.sha256(img_data).hexdigest(),
                         'index': i,
                         'filename': filename,
                         'extension': filename.split('.')[-1] if '.' in filename else 'png',
-                        'size': pil_image.size
+                        'size': image_size
                     }
                     
                     images.append(image_info)
                     
                 except Exception as img_error:
-                    st.warning(f"Could not process image {img_file}: {img_error}")
+                    log.append(("warning", f"Could not process image {img_file}: {img_error}"))
                     continue
                     
         return images
         
     except Exception as e:
-        st.error(f"Error extracting images from DOCX: {e}")
+        log.append(("error", f"Error extracting images from DOCX: {e}"))
         return []
 
-def match_images_to_scenarios(parsed_scenarios, extracted_images, file_name):
-    """Match extracted images to parsed scenarios and upload to Supabase"""
-    updated_scenarios = []
-    
+def match_images_to_scenarios(parsed_scenarios, extracted_images, file_name, log):
+    """Match extracted images to parsed scenarios and upload them to Supabase concurrently"""
+    # Work out which image belongs to which scenario before uploading anything
+    upload_tasks = {}
     for i, scenario in enumerate(parsed_scenarios):
-        scenario_copy = scenario.copy()
-        
         # Check if this scenario should have an image
         has_image = scenario.get('hasImage', False)
         image_position = scenario.get('imagePosition', i)  # Default to scenario index if not specified
         
+        if image_position is None:
+            image_position = i
+        
         if has_image and image_position < len(extracted_images):
-            try:
-                # Get the corresponding image
-                image_info = extracted_images[image_position]
-                
-                # Upload image to Supabase Storage
-                image_url = upload_image_to_supabase_storage(
-                    image_info['data'], 
+            upload_tasks[i] = extracted_images[image_position]
+    
+    # Scenarios sharing the same image bytes share a single upload
+    unique_uploads = {}
+    for i, image_info in upload_tasks.items():
+        unique_uploads.setdefault(image_info['sha256'], (i, image_info))
+    
+    urls_by_digest = {}
+    if unique_uploads:
+        with ThreadPoolExecutor(max_workers=min(16, len(unique_uploads))) as executor:
+            futures = {
+                executor.submit(
+                    upload_image_to_supabase_storage,
+                    image_info['data'],
                     image_info['filename'],
+                    log,
                     scenario_index=i
-                )
-                
-                if image_url:
-                    scenario_copy['image'] = image_url
-                    st.success(f"Linked image to scenario {i + 1} from {file_name}")
-                else:
-                    st.warning(f"Failed to upload image for scenario {i + 1}")
-                    
-            except Exception as e:
-                st.error(f"Error processing image for scenario {i + 1}: {e}")
+                ): (i, digest)
+                for digest, (i, image_info) in unique_uploads.items()
+            }
+            
+            for future in as_completed(futures):
+                i, digest = futures[future]
+                try:
+                    urls_by_digest[digest] = future.result()
+                except Exception as e:
+                    log.append(("error", f"Error processing image for scenario {i + 1}: {e}"))
+    
+    image_urls = {i: urls_by_digest.get(image_info['sha256']) for i, image_info in upload_tasks.items()}
+    
+    updated_scenarios = []
+    
+    for i, scenario in enumerate(parsed_scenarios):
+        scenario_copy = scenario.copy()
+        
+        if i in upload_tasks:
+            if image_urls.get(i):
+                scenario_copy['image'] = image_urls[i]
+                log.append(("success", f"Linked image to scenario {i + 1} from {file_name}"))
+            else:
+                log.append(("warning", f"Failed to upload image for scenario {i + 1}"))
         
         # Clean up processing fields
         scenario_copy.pop('hasImage', None)
@@ -211,60 +319,846 @@ def match_images_to_scenarios(parsed_scenarios, extracted_images, file_name):
     
     return updated_scenarios
 
-def process_file_with_enhanced_extraction(uploaded_file):
+def extract_text_and_images_from_docx(docx_bytes, log):
+    """Extract text and images from DOCX file - docx2txt and zipfile both accept file-like objects"""
+    text_content = docx2txt.process(BytesIO(docx_bytes))
+    extracted_images = extract_images_from_docx_advanced(docx_bytes, log)
+    return text_content, extracted_images
+
+def extract_text_from_txt(txt_bytes, log):
+    """Extract text from TXT file (no images)"""
+    return txt_bytes.decode("utf-8"), []
+
+# Uploaded file MIME type -> handler returning (text, images)
+FILE_TYPE_HANDLERS = {
+    "application/pdf": extract_text_and_images_from_pdf,
+    "application/vnd.openxmlformats-officedocument.wordprocessingml.document": extract_text_and_images_from_docx,
+    "text/plain": extract_text_from_txt
+}
+
+def process_file_with_enhanced_extraction(file_bytes, file_name, file_type, log):
     """Process file and extract both text and images with better coordination"""
-    file_name = uploaded_file.name
-    text_content = ""
-    extracted_images = []
+    handler = FILE_TYPE_HANDLERS.get(file_type)
+    if handler is None:
+        log.append(("error", f"Unsupported file type: {file_type}"))
+        return None, None
     
     try:
-        if uploaded_file.type == "application/pdf":
-            # For PDFs
-            with NamedTemporaryFile(delete=False, suffix=".pdf") as temp_pdf:
-                temp_pdf.write(uploaded_file.read())
-                temp_pdf.flush()
-                
-                # Extract text using PyPDF2
-                reader = PyPDF2.PdfReader(temp_pdf.name)
-                for page in reader.pages:
-                    text_content += page.extract_text() + "\n"
-                
-                # Extract images using PyMuPDF (more advanced)
-                extracted_images = extract_images_from_pdf_advanced(temp_pdf.name)
-                
-                os.unlink(temp_pdf.name)  # Clean up temp file
-                
-        elif uploaded_file.type == "application/vnd.openxmlformats-officedocument.wordprocessingml.document":
-            # For DOCX files
-            with NamedTemporaryFile(delete=False, suffix=".docx") as temp_docx:
-                temp_docx.write(uploaded_file.read())
-                temp_docx.flush()
-                
-                # Extract text
-                text_content = docx2txt.process(temp_docx.name)
-                
-                # Extract images
-                extracted_images = extract_images_from_docx_advanced(temp_docx.name)
-                
-                os.unlink(temp_docx.name)  # Clean up temp file
-                
-        elif uploaded_file.type == "text/plain":
-            # For TXT files (no images)
-            stringio = StringIO(uploaded_file.getvalue().decode("utf-8"))
-            text_content = stringio.read()
-            
-        else:
-            st.error(f"Unsupported file type: {uploaded_file.type}")
-            return None, None
-            
+        text_content, extracted_images = handler(file_bytes, log)
     except Exception as e:
-        st.error(f"Error processing {file_name}: {e}")
+        log.append(("error", f"Error processing {file_name}: {e}"))
         return None, None
     
     return text_content, extracted_images
 
+# Text Parsing Functions
+SCENARIO_HEADING_PATTERN = re.compile(r'(?im)^(?=[ \t]*(?:#+[ \t]*)?(?:\*\*)?(?:scenario|case)[ \t]+\d+)')
+
+SYSTEM_PROMPT = """You extract SAQ (Short Answer Question) clinical scenarios from document text into JSON matching the response schema.
+
+- parentQuestion: the full clinical scenario/case description
+- moduleId: the module ID given for the scenario in the document
+- hasImage / imagePosition: set hasImage when the scenario refers to an image, figure, ECG, X-ray or other visual ("the ECG above", "refer to the image"); imagePosition is the 0-based order of that image in the document, otherwise null
+- childQuestions: every question for the scenario, with questionLead, idealAnswer, keyConcept (main concept tested) and total_marks
+
+Rules:
+- Parse ALL scenarios in the text, not just the first one
+- Group related questions under the same parent scenario
+- Copy ideal answers word for word - never summarize or omit details
+"""
+
+# Structured-output schema; strict mode guarantees the completion parses and matches it
+SAQ_CHILD_QUESTION_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "questionLead": {"type": "string"},
+        "idealAnswer": {"type": "string"},
+        "keyConcept": {"type": "string"},
+        "total_marks": {"type": "integer"}
+    },
+    "required": ["questionLead", "idealAnswer", "keyConcept", "total_marks"],
+    "additionalProperties": False
+}
+
+SAQ_SCENARIO_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "parentQuestion": {"type": "string"},
+        "moduleId": {"type": "integer"},
+        "hasImage": {"type": "boolean"},
+        "imagePosition": {"type": ["integer", "null"]},
+        "childQuestions": {"type": "array", "items": SAQ_CHILD_QUESTION_SCHEMA}
+    },
+    "required": ["parentQuestion", "moduleId", "hasImage", "imagePosition", "childQuestions"],
+    "additionalProperties": False
+}
+
+SAQ_RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "scenarios": {"type": "array", "items": SAQ_SCENARIO_SCHEMA}
+    },
+    "required": ["scenarios"],
+    "additionalProperties": False
+}
+
+# Several small documents parsed in one request, keyed by the fileId given in the prompt
+SAQ_BATCH_RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "files": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "fileId": {"type": "integer"},
+                    "scenarios": {"type": "array", "items": SAQ_SCENARIO_SCHEMA}
+                },
+                "required": ["fileId", "scenarios"],
+                "additionalProperties": False
+            }
+        }
+    },
+    "required": ["files"],
+    "additionalProperties": False
+}
+
+# Image-free files up to this many characters are parsed together, BATCH_SIZE per request
+BATCH_SIZE = 5
+BATCH_MAX_FILE_CHARS = 4000
+
+# Bump when SYSTEM_PROMPT or the schemas change so cached parses are not reused
+PROMPT_VERSION = "v2"
+
+# Parses are also persisted in Supabase so they survive restarts and are shared between sessions:
+#   create table llm_cache (
+#     hash text not null,
+#     prompt_version text not null,
+#     response jsonb not null,
+#     created_at timestamptz not null default now(),
+#     primary key (hash, prompt_version)
+#   );
+# The app keeps working (without the persistent layer) if the table does not exist.
+def read_cached_parse(cache_hash, model):
+    """Return a stored parse from the llm_cache table, or None on a miss"""
+    try:
+        response = supabase.table("llm_cache").select("response").eq("hash", cache_hash).eq(
+            "prompt_version", f"{PROMPT_VERSION}/{model}"
+        ).execute()
+    except Exception:
+        return None
+    return response.data[0]['response'] if response.data else None
+
+def store_cached_parse(cache_hash, model, parsed_data):
+    """Record a parse for this process and persist it to llm_cache; table failures only cost a future miss"""
+    remember_parse(cache_hash, model, parsed_data)
+    try:
+        supabase.table("llm_cache").upsert({
+            'hash': cache_hash,
+            'prompt_version': f"{PROMPT_VERSION}/{model}",
+            'response': parsed_data
+        }).execute()
+    except Exception:
+        pass
+
+@st.cache_resource(show_spinner=False)
+def get_parsed_responses():
+    """Process-wide LRU map of (prompt version/model, llm_cache key) to serialized parse, with its lock"""
+    return OrderedDict(), threading.Lock()
+
+# Bound on parses held in memory; older ones fall back to llm_cache
+PARSED_RESPONSES_MAX_ENTRIES = 256
+
+def parsed_response_key(cache_hash, model):
+    """Key into the process-wide parse map, matching llm_cache's (hash, prompt_version)"""
+    return (f"{PROMPT_VERSION}/{model}", cache_hash)
+
+def remember_parse(cache_hash, model, parsed_data):
+    """Record a parse in the process-wide map"""
+    # Stored serialized, so callers editing the scenarios they get back can't change the stored parse
+    serialized = orjson.dumps(parsed_data, option=orjson.OPT_NON_STR_KEYS)
+    parsed_responses, lock = get_parsed_responses()
+    with lock:
+        parsed_responses[parsed_response_key(cache_hash, model)] = serialized
+        parsed_responses.move_to_end(parsed_response_key(cache_hash, model))
+        while len(parsed_responses) > PARSED_RESPONSES_MAX_ENTRIES:
+            parsed_responses.popitem(last=False)
+
+def lookup_cached_parse(cache_hash, model):
+    """Return a parse this process already holds or one stored in llm_cache, or None on a miss"""
+    parsed_responses, lock = get_parsed_responses()
+    with lock:
+        serialized = parsed_responses.get(parsed_response_key(cache_hash, model))
+        if serialized is not None:
+            parsed_responses.move_to_end(parsed_response_key(cache_hash, model))
+    if serialized is not None:
+        return orjson.loads(serialized)
+    
+    cached = read_cached_parse(cache_hash, model)
+    if cached is not None:
+        remember_parse(cache_hash, model, cached)
+    return cached
+
+def find_uncached_parses(cache_hashes, model):
+    """Return the keys with no parse in this process or llm_cache, loading the llm_cache hits in batched lookups"""
+    parsed_responses, lock = get_parsed_responses()
+    with lock:
+        missing = [cache_hash for cache_hash in cache_hashes if parsed_response_key(cache_hash, model) not in parsed_responses]
+    
+    try:
+        stored = select_rows_in(
+            "llm_cache", "hash,response", "hash", missing,
+            eq_filters={"prompt_version": f"{PROMPT_VERSION}/{model}"}, order_by=["hash"]
+        )
+    except Exception:
+        stored = []
+    
+    for row in stored:
+        remember_parse(row['hash'], model, row['response'])
+    stored_hashes = {row['hash'] for row in stored}
+    return [cache_hash for cache_hash in missing if cache_hash not in stored_hashes]
+
+def text_hash_of(text_content):
+    """SHA-256 of a block of text, used to key its cached parse"""
+    return hashlib.sha256(text_content.encode("utf-8")).hexdigest()
+
+def batch_hash_of(text_contents):
+    """SHA-256 identifying an ordered group of documents parsed together"""
+    return text_hash_of("".join(text_hash_of(text_content) for text_content in text_contents))
+
+def parse_cache_key(text_hash, image_count):
+    """llm_cache key for a single-document parse"""
+    return hashlib.sha256(f"{text_hash}:{image_count}".encode("utf-8")).hexdigest()
+
+def batch_cache_key(batch_hash):
+    """llm_cache key for a multi-document parse"""
+    return hashlib.sha256(f"{batch_hash}:batch".encode("utf-8")).hexdigest()
+
+def build_parse_message(text_content, image_count):
+    """User message for parsing one document or scenario block"""
+    # Static instructions live in SYSTEM_PROMPT so OpenAI's prompt cache can reuse the prefix;
+    # only the document-specific context and text are sent per call
+    image_context = f"IMPORTANT: This document contains {image_count} extracted images." if image_count else "Note: No images were found in this document."
+    return f"{image_context}\n\nText to parse:\n{text_content}"
+
+def build_batch_message(text_contents):
+    """User message for parsing several small image-free documents at once"""
+    file_sections = "\n".join(
+        f"===FILE id={file_id}===\n{text_content}\n===END==="
+        for file_id, text_content in enumerate(text_contents)
+    )
+    return (
+        f"The text below contains {len(text_contents)} separate documents, each between ===FILE id=<n>=== and ===END=== markers. "
+        "Parse each document independently and return one entry per fileId in the \"files\" array, "
+        "with an empty scenarios array if a document has none. No images were found in these documents.\n\n"
+        f"{file_sections}"
+    )
+
+def build_completion_request(model, user_content, schema_name, schema):
+    """Chat completion arguments shared by live calls and Batch API requests"""
+    return {
+        "model": model,
+        "messages": [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": user_content}
+        ],
+        "temperature": 0,
+        "response_format": {
+            "type": "json_schema",
+            "json_schema": {"name": schema_name, "schema": schema, "strict": True}
+        }
+    }
+
+# Upper bound on in-flight OpenAI requests across all file and block workers, to stay under rate limits
+OPENAI_MAX_CONCURRENCY = 8
+
+@st.cache_resource(show_spinner=False)
+def get_openai_semaphore():
+    """Process-wide semaphore limiting concurrent OpenAI requests"""
+    return threading.BoundedSemaphore(OPENAI_MAX_CONCURRENCY)
+
+# Characters received so far from OpenAI streams in this script run; the main thread
+# displays it while worker threads are parsing
+stream_progress = {'chars': 0}
+stream_progress_lock = threading.Lock()
+
+def is_transient_openai_error(error):
+    """Whether a failed completion is worth retrying (connection errors, 408/409/429/5xx, malformed JSON)"""
+    if isinstance(error, (APIConnectionError, json.JSONDecodeError)):
+        return True
+    if isinstance(error, APIStatusError):
+        return error.status_code in (408, 409, 429) or error.status_code >= 500
+    return False
+
+class OutputTruncatedError(ValueError):
+    """A completion stopped at the output token limit, so its JSON is incomplete"""
+
+# Transient failures are retried with jittered exponential backoff; the last error is
+# re-raised once attempts run out
+@retry(
+    wait=wait_random_exponential(min=1, max=30),
+    stop=stop_after_attempt(6),
+    retry=retry_if_exception(is_transient_openai_error),
+    reraise=True
+)
+def run_structured_completion(request):
+    """Stream one structured-output completion and return the decoded JSON"""
+    # Hold the semaphore until the stream is drained - the request is in flight until then
+    with get_openai_semaphore():
+        response = client.chat.completions.create(**request, stream=True)
+        
+        # Accumulate the streamed output - tokens start arriving long before the completion ends
+        response_parts = []
+        refusal_parts = []
+        finish_reason = None
+        for chunk in response:
+            if not chunk.choices:
+                continue
+            choice = chunk.choices[0]
+            if choice.delta.content:
+                response_parts.append(choice.delta.content)
+                with stream_progress_lock:
+                    stream_progress['chars'] += len(choice.delta.content)
+            if getattr(choice.delta, 'refusal', None):
+                refusal_parts.append(choice.delta.refusal)
+            if choice.finish_reason:
+                finish_reason = choice.finish_reason
+    
+    if refusal_parts:
+        raise ValueError(f"Model refused to parse the text: {''.join(refusal_parts)}")
+    if finish_reason == "length":
+        raise OutputTruncatedError("Completion hit the output token limit before the JSON was complete")
+    
+    return orjson.loads("".join(response_parts))
+
+def run_completion_with_fallback(request):
+    """Run a completion, re-sending it once to openai_fallback_model if the output is cut off"""
+    try:
+        return run_structured_completion(request)
+    except OutputTruncatedError:
+        if request["model"] == openai_fallback_model:
+            raise
+        return run_structured_completion({**request, "model": openai_fallback_model})
+
+@st.cache_data(show_spinner=False, max_entries=128)
+def llm_parse(text_hash, image_count, model, prompt_version, _text_content):
+    """Parse SAQ text into scenario dicts with OpenAI, cached on text_hash and backed by llm_cache"""
+    # st.cache_data skips the underscore-prefixed _text_content; text_hash stands in for it
+    cache_hash = parse_cache_key(text_hash, image_count)
+    cached = lookup_cached_parse(cache_hash, model)
+    if cached is not None:
+        return cached
+    
+    parsed_data = run_completion_with_fallback(build_completion_request(
+        model,
+        build_parse_message(_text_content, image_count),
+        "saq_scenarios",
+        SAQ_RESPONSE_SCHEMA
+    ))['scenarios']
+    
+    store_cached_parse(cache_hash, model, parsed_data)
+    return parsed_data
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def llm_parse_batch(batch_hash, model, prompt_version, _text_contents):
+    """Parse several small image-free documents with one OpenAI request, returning fileId -> scenarios"""
+    cache_hash = batch_cache_key(batch_hash)
+    cached = lookup_cached_parse(cache_hash, model)
+    if cached is not None:
+        # JSON object keys come back from jsonb and the serialized in-memory map as strings
+        return {int(file_id): scenarios for file_id, scenarios in cached.items()}
+    
+    parsed_data = run_completion_with_fallback(build_completion_request(
+        model,
+        build_batch_message(_text_contents),
+        "saq_batch",
+        SAQ_BATCH_RESPONSE_SCHEMA
+    ))
+    batch_results = {entry['fileId']: entry['scenarios'] for entry in parsed_data['files']}
+    
+    store_cached_parse(cache_hash, model, batch_results)
+    return batch_results
+
+# OpenAI Batch API (opt-in): half the token price and a separate rate-limit pool,
+# with results guaranteed within 24 hours
+BATCH_POLL_SECONDS = 30
+# SDK retries (with its own backoff) for each Batch API call
+BATCH_API_MAX_RETRIES = 5
+
+def run_openai_batch(requests, status):
+    """Run custom_id -> request body through the Batch API, resuming this session's batch; returns custom_id -> content"""
+    pending = st.session_state.get('openai_batch')
+    # The shared client has SDK retries off (tenacity covers completions); batch calls keep them
+    batch_client = client.with_options(max_retries=BATCH_API_MAX_RETRIES)
+    
+    # Resume a batch this session already submitted (a rerun interrupted the wait) rather than paying twice
+    if pending and set(requests) & set(pending['custom_ids']):
+        batch_id = pending['id']
+    else:
+        try:
+            batch_input = b"\n".join(
+                orjson.dumps({"custom_id": custom_id, "method": "POST", "url": "/v1/chat/completions", "body": body})
+                for custom_id, body in requests.items()
+            )
+            batch_file = batch_client.files.create(file=("saq_batch.jsonl", batch_input), purpose="batch")
+            batch_id = batch_client.batches.create(
+                input_file_id=batch_file.id,
+                endpoint="/v1/chat/completions",
+                completion_window="24h"
+            ).id
+        except Exception as e:
+            status.warning(f"Could not submit the OpenAI batch ({e}); parsing live instead")
+            return {}
+        st.session_state['openai_batch'] = {'id': batch_id, 'custom_ids': list(requests)}
+    
+    # Once submitted the batch is billed, so transient polling errors keep waiting instead of giving up
+    while True:
+        try:
+            batch = batch_client.batches.retrieve(batch_id)
+        except Exception as e:
+            if not is_transient_openai_error(e):
+                st.session_state.pop('openai_batch', None)
+                status.warning(f"Could not check OpenAI batch {batch_id} ({e}); parsing live instead")
+                return {}
+            status.warning(f"Could not reach OpenAI to check batch {batch_id} ({e}); retrying...")
+        else:
+            if batch.status in ("completed", "failed", "expired", "cancelled"):
+                break
+            counts = batch.request_counts
+            done = f" ({counts.completed}/{counts.total} requests done)" if counts else ""
+            status.info(f"⏳ OpenAI batch {batch_id} is {batch.status}{done}. Keep this page open...")
+        time.sleep(BATCH_POLL_SECONDS)
+    
+    # Expired and cancelled batches still hand back the requests that finished (and were paid for)
+    if not batch.output_file_id:
+        st.session_state.pop('openai_batch', None)
+        status.warning(f"OpenAI batch {batch_id} ended as {batch.status}; parsing live instead")
+        return {}
+    
+    try:
+        batch_output = batch_client.files.content(batch.output_file_id).content
+    except Exception as e:
+        # Keep the batch id so a rerun can download the results instead of resubmitting
+        status.warning(f"Could not download OpenAI batch {batch_id} results ({e}); parsing live instead")
+        return {}
+    st.session_state.pop('openai_batch', None)
+    
+    contents = {}
+    for line in batch_output.splitlines():
+        result = orjson.loads(line)
+        response = result.get('response') or {}
+        if response.get('status_code') == 200:
+            contents[result['custom_id']] = response['body']['choices'][0]['message']['content']
+    
+    if batch.status == "completed":
+        status.empty()
+    else:
+        status.warning(f"OpenAI batch {batch_id} ended as {batch.status}; parsing its unfinished requests live")
+    return contents
+
+def prefetch_with_openai_batch(parse_units, extracted, status):
+    """Parse this run's uncached requests through the Batch API and store them where llm_parse looks"""
+    requests = {}
+    for indices in parse_units:
+        if len(indices) > 1:
+            text_contents = [extracted[index][0] for index in indices]
+            requests[batch_cache_key(batch_hash_of(text_contents))] = build_completion_request(
+                openai_model, build_batch_message(text_contents), "saq_batch", SAQ_BATCH_RESPONSE_SCHEMA
+            )
+        else:
+            text_content, extracted_images, _ = extracted[indices[0]]
+            for chunk, _, image_count in chunks_for_file(text_content, extracted_images):
+                requests[parse_cache_key(text_hash_of(chunk), image_count)] = build_completion_request(
+                    openai_model, build_parse_message(chunk, image_count), "saq_scenarios", SAQ_RESPONSE_SCHEMA
+                )
+    
+    uncached = find_uncached_parses(list(requests), openai_model)
+    if not uncached:
+        return
+    
+    contents = run_openai_batch({cache_hash: requests[cache_hash] for cache_hash in uncached}, status)
+    
+    # A resumed batch may also hold results for an earlier upload; the response shape
+    # tells the two request kinds apart, so those are kept too
+    for cache_hash, json_response in contents.items():
+        try:
+            parsed_data = orjson.loads(json_response)
+        except json.JSONDecodeError:
+            continue
+        
+        if 'files' in parsed_data:
+            parsed_data = {entry['fileId']: entry['scenarios'] for entry in parsed_data['files']}
+        else:
+            parsed_data = parsed_data['scenarios']
+        
+        store_cached_parse(cache_hash, openai_model, parsed_data)
+
+def split_into_scenario_chunks(text, min_chunk_chars=1000):
+    """Split document text on "Scenario N" / "Case N" headings so each block can be parsed separately"""
+    pieces = SCENARIO_HEADING_PATTERN.split(text)
+    preamble = "" if SCENARIO_HEADING_PATTERN.match(pieces[0]) else pieces.pop(0)
+    
+    # Collect each block's pieces in a list and join once, rather than growing a string
+    chunks = []
+    current = []
+    current_chars = 0
+    for piece in pieces:
+        current.append(piece)
+        current_chars += len(piece)
+        if current_chars >= min_chunk_chars:
+            chunks.append("".join(current))
+            current = []
+            current_chars = 0
+    
+    remainder = "".join(current)
+    if remainder.strip():
+        if chunks:
+            chunks[-1] = chunks[-1] + remainder
+        else:
+            chunks.append(remainder)
+    
+    if len(chunks) <= 1:
+        return [text]
+    return [preamble + chunk for chunk in chunks]
+
+# Token budget for one parse request; larger blocks are split into paragraph windows so
+# a long document cannot overflow the context window or truncate the JSON output
+MAX_CHUNK_TOKENS = 8000
+
+@st.cache_resource(show_spinner=False)
+def get_token_encoder(model):
+    """tiktoken encoding for the parsing model (o200k_base for unknown names), or None if it cannot be loaded"""
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding("o200k_base")
+    except Exception:
+        return None
+
+def count_tokens(text):
+    """Token count of text for the parsing model, or a chars / 4 estimate without tiktoken"""
+    encoder = get_token_encoder(openai_model)
+    if encoder is None:
+        return len(text) // 4
+    return len(encoder.encode(text))
+
+def split_on_token_budget(text, max_tokens=MAX_CHUNK_TOKENS):
+    """Greedily pack paragraphs into windows of at most max_tokens, overlapping by one paragraph"""
+    if count_tokens(text) <= max_tokens:
+        return [text]
+    
+    windows = []
+    current = []
+    current_tokens = 0
+    for paragraph in text.split("\n\n"):
+        paragraph_tokens = count_tokens(paragraph)
+        if current and current_tokens + paragraph_tokens > max_tokens:
+            windows.append("\n\n".join(current))
+            overlap, overlap_tokens = current[-1], count_tokens(current[-1])
+            if overlap_tokens + paragraph_tokens <= max_tokens:
+                current, current_tokens = [overlap], overlap_tokens
+            else:
+                current, current_tokens = [], 0
+        current.append(paragraph)
+        current_tokens += paragraph_tokens
+    
+    if current:
+        windows.append("\n\n".join(current))
+    return windows
+
+def merge_split_scenarios(scenarios):
+    """Merge scenarios sharing a parentQuestion across blocks, de-duplicating childQuestions on questionLead"""
+    merged = {}
+    for scenario in scenarios:
+        key = scenario.get('parentQuestion', '').strip()
+        if key not in merged:
+            merged[key] = scenario
+            continue
+        
+        children = merged[key].setdefault('childQuestions', [])
+        seen_leads = {child.get('questionLead', '').strip() for child in children}
+        for child in scenario.get('childQuestions', []):
+            lead = child.get('questionLead', '').strip()
+            if lead not in seen_leads:
+                children.append(child)
+                seen_leads.add(lead)
+    
+    return list(merged.values())
+
+def parse_text_chunk(text_content, image_count, label, log):
+    """Parse one block of text with OpenAI. Returns None on failure."""
+    text_hash = text_hash_of(text_content)
+    
+    try:
+        return llm_parse(text_hash, image_count, openai_model, PROMPT_VERSION, text_content)
+    
+    except json.JSONDecodeError as json_error:
+        # Structured outputs make this rare; truncated completions are reported as ValueError instead
+        log.append(("error", f"Failed to parse JSON for {label}"))
+        log.append(("error", f"JSON Error: {json_error}"))
+        log.append(("raw", json_error.doc))
+    
+    except Exception as e:
+        log.append(("error", f"Error processing {label}: {e}"))
+    
+    return None
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def extract_one_file(file_hash, file_name, file_type, _file_bytes):
+    """Extract text and images from one file off the main thread, returning (text, images, log)"""
+    log = []
+    
+    # Process file and extract text and images
+    text_content, extracted_images = process_file_with_enhanced_extraction(_file_bytes, file_name, file_type, log)
+    
+    if text_content is None:
+        return None, [], log
+    
+    if extracted_images:
+        log.append(("success", f"Extracted {len(extracted_images)} images from **{file_name}**"))
+    else:
+        log.append(("info", f"ℹ️ No images found in **{file_name}**"))
+    
+    return text_content, extracted_images, log
+
+def is_batchable(text_content, extracted_images):
+    """Whether a file is small and image-free enough to share an OpenAI request with others"""
+    return not extracted_images and len(text_content) <= BATCH_MAX_FILE_CHARS
+
+def small_file_cache_key(text_content):
+    """llm_cache key a batchable file's scenarios are stored under, whether parsed alone or in a group"""
+    return parse_cache_key(text_hash_of(text_content), 0)
+
+def plan_parse_units(extracted):
+    """Group extracted files into parse units (lists of file indices): uncached small image-free files BATCH_SIZE at a time"""
+    parse_units = []
+    batchable = []
+    for index, (text_content, extracted_images, _) in enumerate(extracted):
+        if text_content is None:
+            continue
+        if is_batchable(text_content, extracted_images):
+            batchable.append(index)
+        else:
+            parse_units.append([index])
+    
+    # Files already parsed (alone or in an earlier group) are served from their own cache
+    # entry, so only the misses are grouped and adding or removing a file regroups nothing else
+    cache_keys = {index: small_file_cache_key(extracted[index][0]) for index in batchable}
+    uncached = set(find_uncached_parses(list(cache_keys.values()), openai_model))
+    parse_units.extend([index] for index in batchable if cache_keys[index] not in uncached)
+    batchable = [index for index in batchable if cache_keys[index] in uncached]
+    
+    parse_units.extend(batchable[start:start + BATCH_SIZE] for start in range(0, len(batchable), BATCH_SIZE))
+    return parse_units
+
+def split_pages_on_token_budget(text_content, extracted_images, max_tokens=MAX_CHUNK_TOKENS):
+    """Pack a PDF's pages into windows of at most max_tokens, as (text, image_offset, image_count)"""
+    images_per_page = Counter(image['page'] for image in extracted_images)
+    
+    windows = []
+    current = []
+    current_tokens = 0
+    current_images = 0
+    image_offset = 0
+    for page_number, page_text in enumerate(text_content.split(PAGE_BREAK), start=1):
+        page_tokens = count_tokens(page_text)
+        if current and current_tokens + page_tokens > max_tokens:
+            windows.append((PAGE_BREAK.join(current), image_offset, current_images))
+            image_offset += current_images
+            current, current_tokens, current_images = [], 0, 0
+        current.append(page_text)
+        current_tokens += page_tokens
+        current_images += images_per_page[page_number]
+    
+    if current:
+        windows.append((PAGE_BREAK.join(current), image_offset, current_images))
+    return windows
+
+def chunks_for_file(text_content, extracted_images):
+    """Blocks a file is parsed in, as (text, image_offset, image_count)"""
+    # Small files stay whole so they share one cache key with their grouped parse
+    if is_batchable(text_content, extracted_images):
+        return [(text_content, 0, 0)]
+    
+    if not extracted_images:
+        return [
+            (window, 0, 0)
+            for chunk in split_into_scenario_chunks(text_content)
+            for window in split_on_token_budget(chunk)
+        ]
+    
+    # imagePosition is counted from the start of the text the model sees, so documents with
+    # images are only split on PDF page boundaries, where each window's images are known
+    if count_tokens(text_content) <= MAX_CHUNK_TOKENS or PAGE_BREAK not in text_content or \
+            any('page' not in image for image in extracted_images):
+        return [(text_content, 0, len(extracted_images))]
+    return split_pages_on_token_budget(text_content, extracted_images)
+
+def finalize_scenarios(parsed_data, extracted_images, file_name, log):
+    """Attach uploaded images to parsed scenarios and strip the processing-only fields"""
+    # Add source file info
+    for scenario in parsed_data:
+        scenario['source_file'] = file_name
+    
+    # Match images to scenarios and upload them
+    if extracted_images:
+        log.append(("info", f"🔗 Matching {len(extracted_images)} images to {len(parsed_data)} scenarios..."))
+        final_scenarios = match_images_to_scenarios(parsed_data, extracted_images, file_name, log)
+    else:
+        # No images to process, just clean up fields
+        final_scenarios = []
+        for scenario in parsed_data:
+            scenario.pop('hasImage', None)
+            scenario.pop('imagePosition', None) 
+            scenario.pop('source_file', None)
+            final_scenarios.append(scenario)
+    
+    # Count total child questions
+    total_child_questions = sum(len(scenario.get('childQuestions', [])) for scenario in final_scenarios)
+    log.append(("success", f"Successfully processed **{file_name}** with {len(final_scenarios)} scenarios and {total_child_questions} questions"))
+    return final_scenarios
+
+def parse_extracted_file(text_content, extracted_images, file_name, log):
+    """Parse and image-match one file's extracted content. Returns None on failure."""
+    chunks = chunks_for_file(text_content, extracted_images)
+    
+    if len(chunks) > 1:
+        log.append(("info", f"✂️ Parsing **{file_name}** as {len(chunks)} scenario blocks in parallel"))
+        labels = [f"{file_name} (block {k + 1}/{len(chunks)})" for k in range(len(chunks))]
+    else:
+        labels = [file_name]
+    
+    # Use OpenAI API to parse the content with enhanced image awareness
+    with ThreadPoolExecutor(max_workers=min(8, len(chunks))) as executor:
+        chunk_results = list(executor.map(
+            lambda chunk, label: parse_text_chunk(chunk[0], chunk[2], label, log),
+            chunks,
+            labels
+        ))
+    
+    if any(result is None for result in chunk_results):
+        return None
+    
+    # Each window numbers its own images from 0; shift them back to document positions
+    for (_, image_offset, _), result in zip(chunks, chunk_results):
+        for scenario in result:
+            if image_offset and scenario.get('imagePosition') is not None:
+                scenario['imagePosition'] += image_offset
+    
+    parsed_data = [scenario for result in chunk_results for scenario in result]
+    if len(chunks) > 1:
+        parsed_data = merge_split_scenarios(parsed_data)
+    return finalize_scenarios(parsed_data, extracted_images, file_name, log)
+
+def parse_file_batch(files):
+    """Parse a group of (text, file_name, log) small files together, falling back to single parses"""
+    text_contents = [text_content for text_content, _, _ in files]
+    batch_hash = batch_hash_of(text_contents)
+    
+    try:
+        batch_results = llm_parse_batch(batch_hash, openai_model, PROMPT_VERSION, text_contents)
+    except Exception as e:
+        batch_results = {}
+        for _, file_name, log in files:
+            log.append(("warning", f"Batched parse failed ({e}); parsing **{file_name}** on its own"))
+    
+    results = []
+    for file_id, (text_content, file_name, log) in enumerate(files):
+        if file_id in batch_results:
+            store_cached_parse(small_file_cache_key(text_content), openai_model, batch_results[file_id])
+            results.append(finalize_scenarios(batch_results[file_id], [], file_name, log))
+        else:
+            results.append(parse_extracted_file(text_content, [], file_name, log))
+    
+    return results
+
+def submit_parse_unit(executor, indices, extracted, file_names):
+    """Schedule one parse unit from plan_parse_units on the executor and return its future"""
+    if len(indices) == 1:
+        index = indices[0]
+        text_content, extracted_images, log = extracted[index]
+        return executor.submit(parse_extracted_file, text_content, extracted_images, file_names[index], log)
+    
+    return executor.submit(
+        parse_file_batch,
+        [(extracted[index][0], file_names[index], extracted[index][2]) for index in indices]
+    )
+
+def render_log(log):
+    """Replay messages collected by a worker thread through Streamlit"""
+    for level, message in log:
+        if level == "raw":
+            with st.expander("View raw response"):
+                st.text(message)
+        else:
+            getattr(st, level)(message)
+
+def render_file_result(file_name, extracted_images, log):
+    """Show one processed file's messages and image previews"""
+    st.write(f"📄 **{file_name}**")
+    render_log(log)
+    
+    if extracted_images:
+        # Display extracted images in an expandable section
+        with st.expander(f"Preview images from {file_name}"):
+            cols = st.columns(min(3, len(extracted_images)))
+            for idx, img in enumerate(extracted_images):
+                with cols[idx % 3]:
+                    st.image(img['data'], caption=f"Image {idx + 1}: {img['filename']}", width=200)
+                    st.caption(f"Size: {img.get('size', 'Unknown')}")
+
+
+def quote_filter_value(value):
+    """Quote a value for a PostgREST in.(...) list, escaping backslashes and double quotes"""
+    # postgrest-py's .in_() only quotes values containing ,:() and never escapes inside the quotes
+    escaped = str(value).replace('\\', '\\\\').replace('"', '\\"')
+    return f'"{escaped}"'
+
+# PostgREST caps each response (1000 rows by default on Supabase), so lookups page through results
+SELECT_PAGE_SIZE = 1000
+
+def select_in_filter(table, columns, column, values, eq_filters=None, order_by=None):
+    """Fetch every row matching an in.(...) filter of quoted values, one page at a time"""
+    in_list = ",".join(quote_filter_value(value) for value in values)
+    rows = []
+    while True:
+        query = supabase.table(table).select(columns).filter(column, "in", f"({in_list})")
+        for eq_column, eq_value in (eq_filters or {}).items():
+            query = query.eq(eq_column, eq_value)
+        # A total order keeps pages from overlapping or skipping rows
+        for order_column in (order_by or columns.split(",")):
+            query = query.order(order_column)
+        page = query.range(len(rows), len(rows) + SELECT_PAGE_SIZE - 1).execute().data or []
+        rows.extend(page)
+        if len(page) < SELECT_PAGE_SIZE:
+            return rows
+
+def select_rows_in(table, columns, column, values, max_batch_chars=6000, eq_filters=None, order_by=None):
+    """Fetch rows whose column is in values, in as few URL-size-bounded in.(...) queries as possible"""
+    rows = []
+    batch = []
+    batch_chars = 0
+    
+    for value in values:
+        # Count the value as it is sent: quoted, escaped and URL-encoded, plus the separator
+        value_chars = len(quote(quote_filter_value(value))) + 1
+        if batch and batch_chars + value_chars > max_batch_chars:
+            rows.extend(select_in_filter(table, columns, column, batch, eq_filters, order_by))
+            batch = []
+            batch_chars = 0
+        batch.append(value)
+        batch_chars += value_chars
+    
+    if batch:
+        rows.extend(select_in_filter(table, columns, column, batch, eq_filters, order_by))
+    
+    return rows
+
 def upsert_saq_data_to_supabase(parsed_data):
     """Insert SAQ data to both parent and child tables with duplicate checking"""
+    results = []
+    
     try:
         upload_summary = {
             'parent_success': 0,
@@ -276,9 +1170,12 @@ def upsert_saq_data_to_supabase(parsed_data):
         
         progress_bar = st.progress(0)
         
+        # Prepare parent data - ONLY the fields we want, NO ID
+        parent_rows = {}
+        parent_records = {}
+        scenario_keys = []
         for i, scenario_data in enumerate(parsed_data):
             try:
-                # Prepare parent data - ONLY the fields we want, NO ID
                 parent_data = {
                     'parentQuestion': str(scenario_data['parentQuestion']).strip(),
                     'moduleId': int(scenario_data['moduleId'])
@@ -288,95 +1185,147 @@ def upsert_saq_data_to_supabase(parsed_data):
                 if scenario_data.get('image'):
                     parent_data['image'] = str(scenario_data['image']).strip()
                 
-                st.info(f"🔍 Checking for existing parent scenario...")
-                
-                # Check if parent already exists - exact match on parentQuestion
-                existing_parent = supabase.table("saqParent").select("id").eq(
-                    'parentQuestion', scenario_data['parentQuestion'].strip()
+                parent_rows.setdefault(parent_data['parentQuestion'], parent_data)
+                parent_records.setdefault(parent_data['parentQuestion'], f"Scenario {i + 1}")
+                scenario_keys.append(parent_data['parentQuestion'])
+            except Exception as parent_e:
+                results.append({"record": f"Scenario {i + 1}", "status": "error", "message": f"Upload exception: {parent_e}"})
+                upload_summary['parent_errors'] += 1
+                scenario_keys.append(None)
+        
+        # Resolve existing parents in a single query - exact match on parentQuestion
+        existing_parents = select_rows_in("saqParent", "id,parentQuestion", 'parentQuestion', list(parent_rows))
+        parent_id_map = {row['parentQuestion']: row['id'] for row in existing_parents}
+        for question in parent_rows:
+            if question in parent_id_map:
+                results.append({"record": parent_records[question], "status": "existing", "message": "Parent already stored"})
+        progress_bar.progress(0.25)
+        
+        # Bulk insert the missing parents - let database auto-generate IDs
+        new_parents = [row for question, row in parent_rows.items() if question not in parent_id_map]
+        failed_parents = set()
+        if new_parents:
+            parent_error = None
+            try:
+                # The new ids are mapped back to scenarios, so the inserted rows must be returned
+                parent_response = supabase.table("saqParent").insert(
+                    new_parents, returning=ReturnMethod.representation
                 ).execute()
                 
-                if existing_parent.data and len(existing_parent.data) > 0:
-                    # Use existing parent
-                    parent_id = existing_parent.data[0]['id']
-                    st.info(f"📋 Using existing parent scenario ID: {parent_id}")
-                    upload_summary['parent_success'] += 1
+                if hasattr(parent_response, 'error') and parent_response.error:
+                    parent_error = f"Parent table error: {parent_response.error}"
                 else:
-                    # Insert new parent record - let database auto-generate ID
-                    st.info(f"🔄 Inserting new parent record...")
-                    
-                    parent_response = supabase.table("saqParent").insert(parent_data).execute()
-                    
-                    # Check for errors
-                    if hasattr(parent_response, 'error') and parent_response.error:
-                        st.error(f"❌ Parent table error for scenario {i + 1}: {parent_response.error}")
-                        upload_summary['parent_errors'] += 1
-                        continue
-                    
-                    # Get the generated ID
-                    if parent_response.data and len(parent_response.data) > 0:
-                        parent_id = parent_response.data[0]['id']
-                        upload_summary['parent_success'] += 1
-                        st.success(f"✅ Created new parent scenario with ID: {parent_id}")
-                    else:
-                        st.error(f"❌ Could not retrieve parent ID for scenario {i + 1}")
-                        st.error(f"Response: {parent_response}")
-                        upload_summary['parent_errors'] += 1
-                        continue
-                
-                # Process child questions
-                child_questions = scenario_data.get('childQuestions', [])
-                st.info(f"📝 Processing {len(child_questions)} child questions for parent {parent_id}")
-                
-                for j, child_question in enumerate(child_questions):
-                    try:
-                        # Prepare child data - ONLY the fields we want, NO ID
-                        child_data = {
-                            'questionLead': str(child_question['questionLead']).strip(),
-                            'idealAnswer': str(child_question['idealAnswer']).strip(),
-                            'parentQuestionId': int(parent_id),
-                            'keyConcept': str(child_question['keyConcept']).strip(),
-                            'total_marks': int(child_question['total_marks'])
-                        }
-                        
-                        # Check if child question already exists
-                        existing_child = supabase.table("saqChild").select("id").eq(
-                            'questionLead', child_question['questionLead'].strip()
-                        ).eq('parentQuestionId', parent_id).execute()
-                        
-                        if existing_child.data and len(existing_child.data) > 0:
-                            st.info(f"📝 Child question {j + 1} already exists, skipping...")
-                            upload_summary['child_success'] += 1
-                        else:
-                            # Insert child record - let database auto-generate ID
-                            child_response = supabase.table("saqChild").insert(child_data).execute()
-                            
-                            if hasattr(child_response, 'error') and child_response.error:
-                                st.error(f"❌ Child table error for scenario {i + 1}, question {j + 1}: {child_response.error}")
-                                upload_summary['child_errors'] += 1
-                            else:
-                                child_id = child_response.data[0]['id'] if child_response.data else 'unknown'
-                                upload_summary['child_success'] += 1
-                                st.success(f"✅ Created child question {j + 1} with ID: {child_id}")
-                                
-                    except Exception as child_e:
-                        st.error(f"❌ Child question {j + 1} upload exception: {child_e}")
-                        upload_summary['child_errors'] += 1
-                
+                    for row in parent_response.data or []:
+                        parent_id_map[row['parentQuestion']] = row['id']
             except Exception as parent_e:
-                st.error(f"❌ Parent scenario {i + 1} upload exception: {parent_e}")
+                parent_error = f"Parent bulk insert exception: {parent_e}"
+            
+            for row in new_parents:
+                if row['parentQuestion'] in parent_id_map:
+                    results.append({"record": parent_records[row['parentQuestion']], "status": "inserted", "message": "Parent inserted"})
+                else:
+                    failed_parents.add(row['parentQuestion'])
+                    results.append({"record": parent_records[row['parentQuestion']], "status": "error", "message": parent_error or "Parent not returned by insert"})
+        progress_bar.progress(0.5)
+        
+        # Prepare child data - ONLY the fields we want, NO ID
+        child_rows = []
+        child_records = []
+        for i, (scenario_data, parent_key) in enumerate(zip(parsed_data, scenario_keys)):
+            if parent_key is None:
+                continue
+            if parent_key not in parent_id_map:
+                # A failed insert already has its own row in the results table
+                if parent_key not in failed_parents:
+                    results.append({"record": f"Scenario {i + 1}", "status": "error", "message": "Could not retrieve parent ID"})
                 upload_summary['parent_errors'] += 1
+                continue
+            
+            upload_summary['parent_success'] += 1
+            parent_id = parent_id_map[parent_key]
             
-            # Update progress
-            progress_bar.progress((i + 1) / len(parsed_data))
+            for j, child_question in enumerate(scenario_data.get('childQuestions', [])):
+                try:
+                    child_rows.append({
+                        'questionLead': str(child_question['questionLead']).strip(),
+                        'idealAnswer': str(child_question['idealAnswer']).strip(),
+                        'parentQuestionId': int(parent_id),
+                        'keyConcept': str(child_question['keyConcept']).strip(),
+                        'total_marks': int(child_question['total_marks'])
+                    })
+                    child_records.append(f"Scenario {i + 1}, question {j + 1}")
+                except Exception as child_e:
+                    results.append({"record": f"Scenario {i + 1}, question {j + 1}", "status": "error", "message": f"Upload exception: {child_e}"})
+                    upload_summary['child_errors'] += 1
+        
+        # Resolve existing children in a single query - match on questionLead within parent
+        # Parents inserted by this upload have no children yet, so only pre-existing ones are looked up
+        existing_parent_ids = {row['id'] for row in existing_parents}
+        parent_ids = {row['parentQuestionId'] for row in child_rows if row['parentQuestionId'] in existing_parent_ids}
+        existing_children = {
+            (row['questionLead'], row['parentQuestionId'])
+            for row in select_rows_in("saqChild", "questionLead,parentQuestionId", 'parentQuestionId', list(parent_ids))
+        }
+        progress_bar.progress(0.75)
+        
+        new_children = []
+        new_child_records = []
+        for child_data, record in zip(child_rows, child_records):
+            child_key = (child_data['questionLead'], child_data['parentQuestionId'])
+            if child_key in existing_children:
+                # Already stored (or repeated within this upload), skip
+                upload_summary['child_success'] += 1
+                results.append({"record": record, "status": "existing", "message": "Question already stored"})
+            else:
+                existing_children.add(child_key)
+                new_children.append(child_data)
+                new_child_records.append(record)
+        
+        # Bulk insert the new children - let database auto-generate IDs. Nothing reads
+        # the inserted rows back, so skip echoing every idealAnswer in the response
+        if new_children:
+            child_error = None
+            try:
+                child_response = supabase.table("saqChild").insert(
+                    new_children, returning=ReturnMethod.minimal
+                ).execute()
+                
+                if hasattr(child_response, 'error') and child_response.error:
+                    child_error = f"Child table error: {child_response.error}"
+            except Exception as child_e:
+                child_error = f"Child bulk insert exception: {child_e}"
+            
+            if child_error:
+                upload_summary['child_errors'] += len(new_children)
+            else:
+                upload_summary['child_success'] += len(new_children)
+            for record in new_child_records:
+                results.append({
+                    "record": record,
+                    "status": "error" if child_error else "inserted",
+                    "message": child_error or "Question inserted"
+                })
         
+        upload_summary['inserted'] = sum(row['status'] == "inserted" for row in results)
+        progress_bar.progress(1.0)
         progress_bar.empty()
         return upload_summary
         
     except Exception as e:
         st.error(f"❌ General upload error: {e}")
         return None
+    
+    finally:
+        # Render every row-level outcome as one table instead of one element each
+        if results:
+            st.dataframe(results, hide_index=True, use_container_width=True)
 
 # Main File Processing Section
+try:
+    create_supabase_bucket_if_not_exists()
+except Exception as e:
+    st.warning(f"Could not create storage bucket: {e}")
+
 st.title("📋 SAQ Parser with Automatic Image Extraction")
 
 st.write("""
@@ -394,170 +1343,111 @@ uploaded_files = st.file_uploader(
     accept_multiple_files=True
 )
 
+use_batch_mode = st.sidebar.checkbox(
+    "Batch mode (cheaper, slower)",
+    help="Send parsing requests through the OpenAI Batch API at half the token cost. Results can take minutes to hours; keep the page open until they arrive."
+)
+
 if uploaded_files:
     data_list = []
     any_errors = False
-
-    for uploaded_file in uploaded_files:
-        file_name = uploaded_file.name
-        st.write(f"🔄 Processing **{file_name}**...")
-
-        # Process file and extract text and images
-        text_content, extracted_images = process_file_with_enhanced_extraction(uploaded_file)
+    
+    st.write(f"🔄 Processing {len(uploaded_files)} file(s)...")
+    file_progress = st.progress(0)
+    file_results = {}
+    completed = 0
+    
+    file_names = [uploaded_file.name for uploaded_file in uploaded_files]
+    extracted = [None] * len(uploaded_files)
+    
+    # Files are independent, so their extraction and OpenAI calls can overlap. A file parsed
+    # on its own is scheduled as soon as its text is ready; small image-free files wait for
+    # extraction to finish so they can be grouped (batch mode waits for everything)
+    with ThreadPoolExecutor(max_workers=min(8, len(uploaded_files))) as executor:
+        extraction_futures = {
+            executor.submit(
+                extract_one_file,
+                hashlib.sha256(uploaded_file.getvalue()).hexdigest(),
+                uploaded_file.name,
+                uploaded_file.type,
+                uploaded_file.getvalue()
+            ): index
+            for index, uploaded_file in enumerate(uploaded_files)
+        }
+        extractions_left = len(extraction_futures)
+        parse_futures = {}
+        scheduled = set()
         
-        if text_content is None:
-            any_errors = True
-            continue
+        stream_status = st.empty()
+        pending = set(extraction_futures)
         
-        if extracted_images:
-            st.success(f"Extracted {len(extracted_images)} images from **{file_name}**")
+        # Poll rather than block on each future so the streamed output is visible while waiting
+        while pending:
+            done, pending = wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+            if stream_progress['chars']:
+                stream_status.caption(f"📡 Received {stream_progress['chars']:,} characters from OpenAI...")
             
-            # Display extracted images in an expandable section
-            with st.expander(f"Preview images from {file_name}"):
-                cols = st.columns(min(3, len(extracted_images)))
-                for idx, img in enumerate(extracted_images):
-                    with cols[idx % 3]:
-                        if img.get('pil_image'):
-                            st.image(img['pil_image'], caption=f"Image {idx + 1}: {img['filename']}", width=200)
-                        st.caption(f"Size: {img.get('size', 'Unknown')}")
-        else:
-            st.info(f"ℹ️ No images found in **{file_name}**")
-
-        # Use OpenAI API to parse the content with enhanced image awareness
-        max_retries = 3
-        retry_delay = 5
-
-        for attempt in range(max_retries):
-            try:
-                # Create enhanced prompt for SAQ parsing
-                image_context = f"\n\nIMPORTANT: This document contains {len(extracted_images)} extracted images. " if extracted_images else "\n\nNote: No images were found in this document. "
-                
-                prompt = f"""
-                You will be provided with SAQ (Short Answer Questions) data. You must output them in a JSON format representing clinical scenarios with their associated questions.
-                
-                Structure your response as an array of scenario objects, each with the following keys:
-                
-                - parentQuestion (string): The main clinical scenario/case description
-                - moduleId (integer): The module/category ID for this scenario
-                - hasImage (boolean): True if this scenario has an associated image
-                - imagePosition (integer): If hasImage is true, indicate which image corresponds to this scenario (starting from 0)
-                - childQuestions (array): Array of individual questions for this scenario, each containing:
-                  - questionLead (string): The specific question being asked
-                  - idealAnswer (string): The expected/ideal answer
-                  - keyConcept (string): The main concept being tested
-                  - total_marks (integer): The total marks allocated for this question
-                
-                {image_context}
-                When parsing scenarios, look for any references to images, figures, diagrams, ECGs, X-rays, or visual elements.
-                If you detect that a scenario refers to or requires an image (like "based on the ECG above", "the X-ray shows", "refer to the image", etc.), set hasImage to true.
-                For imagePosition, use the order in which images appear in the document (0 for first image, 1 for second, etc.).
-                
-                You will categorise each scenario via the module they come under (the ID number for each scenario will be provided).
-                
-                Example output format:
-                [
-                  {{
-                    "parentQuestion": "A 65-year-old man with a history of diabetes mellitus presents to the emergency department with crushing chest pain that started 2 hours ago. The pain radiates to his left arm and jaw. He appears diaphoretic and anxious. His blood pressure is 90/60 mmHg, heart rate is 110 bpm, and oxygen saturation is 94% on room air. An ECG shows ST-elevation in leads II, III, and aVF.",
-                    "moduleId": 2,
-                    "hasImage": true,
-                    "imagePosition": 0,
-                    "childQuestions": [
-                      {{
-                        "questionLead": "What is the most likely diagnosis based on the clinical presentation and ECG findings?",
-                        "idealAnswer": "Inferior ST-elevation myocardial infarction (STEMI). The patient presents with typical chest pain, ECG changes showing ST-elevation in the inferior leads (II, III, aVF), and hemodynamic compromise.",
-                        "keyConcept": "STEMI diagnosis and ECG interpretation",
-                        "total_marks": 5
-                      }},
-                      {{
-                        "questionLead": "What immediate management steps should be taken?",
-                        "idealAnswer": "1. Activate cardiac catheterization lab for primary PCI, 2. Administer dual antiplatelet therapy (aspirin + P2Y12 inhibitor), 3. Anticoagulation with heparin, 4. Oxygen if SpO2 <90%, 5. IV access and continuous monitoring, 6. Pain relief with morphine if needed.",
-                        "keyConcept": "STEMI emergency management",
-                        "total_marks": 8
-                      }},
-                      {{
-                        "questionLead": "Which coronary artery is most likely occluded based on the ECG pattern?",
-                        "idealAnswer": "Right coronary artery (RCA). Inferior STEMI with ST-elevation in leads II, III, and aVF typically indicates RCA occlusion, as the RCA usually supplies the inferior wall of the left ventricle.",
-                        "keyConcept": "Coronary anatomy and ECG correlation",
-                        "total_marks": 3
-                      }}
-                    ]
-                  }}
-                ]
-                
-                CRITICAL INSTRUCTIONS:
-                - YOU MUST parse ALL scenarios in the text, not just the first one
-                - Each scenario should be a complete clinical case with multiple related questions
-                - INCLUDE ALL answer details - never summarize
-                - RETAIN EVERY WORD from the ideal answers in the document
-                - Make sure moduleId is always an integer
-                - Make sure total_marks is always an integer
-                - Pay attention to any image references in the text and set hasImage/imagePosition accordingly
-                - Group related questions under the same parent scenario
-                
-                Text to parse:
-                {text_content}
-                """
-
-                response = client.chat.completions.create(
-                    model="gpt-4.1", 
-                    messages=[
-                        {"role": "system", "content": "You are a precise JSON parser that extracts SAQ data while preserving all content and identifying image associations. You structure clinical scenarios with their associated questions."},
-                        {"role": "user", "content": prompt}
-                    ],
-                    temperature=0,
-                    max_tokens=None 
-                )
-                
-                # Parse the JSON output from OpenAI
-                json_response = response.choices[0].message.content.strip()
-                json_response = json_response.replace("```json", "").replace("```", "").strip()
-                
-                # Parse JSON and prepare for image matching
-                parsed_data = json.loads(json_response)
-                
-                # Ensure parsed_data is a list
-                if isinstance(parsed_data, dict):
-                    parsed_data = [parsed_data]
-                
-                # Add source file info
-                for scenario in parsed_data:
-                    scenario['source_file'] = file_name
-                
-                # Match images to scenarios and upload them
-                if extracted_images:
-                    st.info(f"🔗 Matching {len(extracted_images)} images to {len(parsed_data)} scenarios...")
-                    final_scenarios = match_images_to_scenarios(parsed_data, extracted_images, file_name)
-                else:
-                    # No images to process, just clean up fields
-                    final_scenarios = []
-                    for scenario in parsed_data:
-                        scenario.pop('hasImage', None)
-                        scenario.pop('imagePosition', None) 
-                        scenario.pop('source_file', None)
-                        final_scenarios.append(scenario)
+            for future in done:
+                if future in extraction_futures:
+                    index = extraction_futures[future]
+                    try:
+                        extracted[index] = future.result()
+                    except Exception as e:
+                        extracted[index] = (None, [], [("error", f"Error processing {file_names[index]}: {e}")])
+                    text_content, extracted_images, log = extracted[index]
+                    extractions_left -= 1
+                    
+                    if text_content is None:
+                        render_file_result(file_names[index], extracted_images, log)
+                        file_results[index] = None
+                        completed += 1
+                    elif not use_batch_mode and not is_batchable(text_content, extracted_images):
+                        parse_future = submit_parse_unit(executor, [index], extracted, file_names)
+                        parse_futures[parse_future] = [index]
+                        pending.add(parse_future)
+                        scheduled.add(index)
+                    
+                    if extractions_left == 0:
+                        # Small image-free files share a request; everything else is parsed on its own
+                        parse_units = [indices for indices in plan_parse_units(extracted) if indices[0] not in scheduled]
+                        
+                        if use_batch_mode and parse_units:
+                            prefetch_with_openai_batch(parse_units, extracted, st.empty())
+                        
+                        for indices in parse_units:
+                            parse_future = submit_parse_unit(executor, indices, extracted, file_names)
+                            parse_futures[parse_future] = indices
+                            pending.add(parse_future)
+                    continue
                 
-                data_list.extend(final_scenarios)
+                indices = parse_futures[future]
+                try:
+                    result = future.result()
+                    batch_scenarios = result if len(indices) > 1 else [result]
+                except Exception as e:
+                    # One failed request only fails its own files; everything else keeps its results
+                    batch_scenarios = [None] * len(indices)
+                    for index in indices:
+                        extracted[index][2].append(("error", f"Error processing {file_names[index]}: {e}"))
                 
-                # Count total child questions
-                total_child_questions = sum(len(scenario.get('childQuestions', [])) for scenario in final_scenarios)
-                st.success(f"Successfully processed **{file_name}** with {len(final_scenarios)} scenarios and {total_child_questions} questions")
-                break
-            
-            except json.JSONDecodeError as json_error:
-                if attempt < max_retries - 1:
-                    st.warning(f"JSON parsing error for {file_name}. Retrying in {retry_delay} seconds... (Attempt {attempt + 1}/{max_retries})")
-                    time.sleep(retry_delay)
-                else:
-                    st.error(f"Failed to parse JSON for {file_name} after {max_retries} attempts")
-                    st.error(f"JSON Error: {json_error}")
-                    with st.expander("View raw response"):
-                        st.text(json_response)
-                    any_errors = True
+                for index, scenarios in zip(indices, batch_scenarios):
+                    _, extracted_images, log = extracted[index]
+                    render_file_result(file_names[index], extracted_images, log)
+                    file_results[index] = scenarios
+                    completed += 1
             
-            except Exception as e:
-                st.error(f"Error processing {file_name}: {e}")
-                any_errors = True
-                break
+            file_progress.progress(completed / len(uploaded_files))
+        
+        stream_status.empty()
+    
+    file_progress.empty()
+    
+    # Keep scenarios in upload order regardless of completion order
+    for index in range(len(uploaded_files)):
+        if file_results[index] is None:
+            any_errors = True
+        else:
+            data_list.extend(file_results[index])
 
     # Display results and upload option
     if data_list:
@@ -583,13 +1473,17 @@ if uploaded_files:
             st.json(data_list)
 
         # Upload confirmation
-        if st.button("🚀 Upload All Data to Supabase (Parent & Child Tables)", type="primary"):
+        with st.form("upload"):
+            submitted = st.form_submit_button("🚀 Upload All Data to Supabase (Parent & Child Tables)", type="primary")
+        
+        if submitted:
             st.write("📤 Uploading scenarios and questions to Supabase...")
             
             upload_result = upsert_saq_data_to_supabase(data_list)
             
             if upload_result:
                 st.write("### Upload Summary:")
+                st.metric("Inserted", upload_result['inserted'])
                 
                 col1, col2 = st.columns(2)
                 with col1: